@@ -4,84 +4,501 @@
 # Script parameters: <video-id> [video-name]
 # video-id looks like '201234567' and can be obtain from browser network console
 # (you can filter output for "master.mpd" file).
-# This script requires 'ffmpeg' utility
+# This script requires 'ffmpeg' utility and 'requests' Python module
 
+import errno
+import html
+import io
+import json
+import mmap
 import os
+import re
+import shutil
 import subprocess
-import xmltodict
-import urllib.request
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+import requests
+from requests.adapters import HTTPAdapter
 import sys
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from itertools import groupby
+try:
+    import fcntl
+except ImportError:
+    # Windows, there is no O_DIRECT there too
+    fcntl = None
 
 # These constants can be re-assign from environments
 BASEURL = "https://kinescope.io"
 AUDIO_CHUNK_SEGMENTS = 200
 VIDEO_CHUNK_SEGMENTS = 100
 SAFE_CHUNK_LEN = 24000000
+PARALLEL_CHUNKS = 8
+USE_FIFO = 0
+DIRECT_IO = 0
 REFERER = BASEURL
 DEBUG = 0
 
+# progress line is updated not more often than this (seconds), from all download threads together
+PROGRESS_INTERVAL = 0.1
+progress_lock = threading.Lock()
+progress_time = 0.0
 
-def err_exit(err_msg):
-    raise SystemExit(f"Error: {err_msg}")
+# set when all downloads should stop: one of the streams has failed, or the script is interrupted
+stop_download = threading.Event()
 
+# MPD fast path: elements we need, as they are written in usual manifests
+INITIALIZATION_RE = re.compile(rb'<Initialization\b([^>]*)/>')
+SEGMENT_URL_RE = re.compile(rb'<SegmentURL\s+media="([^"]*)"\s+mediaRange="(\d+-\d+)"\s*/>')
+ATTRIBUTE_RE = re.compile(rb'([\w:]+)="([^"]*)"')
 
-def get_media_byte_range(req, from_b, to_b, first_seg, last_seg, total_segs):
-    # print some progress info, apply actual 'Range' header to request object and download the segment
-    info_out = f"Media segment: {last_seg + 1}/{total_segs} ({(last_seg + 1) / total_segs * 100:2.2f}%) "
-    debug_out = f"Media segment: {first_seg + 1}-{last_seg + 1}/{total_segs}\t({last_seg - first_seg + 1})" \
-                f"\tbytes={from_b}-{to_b}\tsize={to_b - from_b + 1}"
-    if debug:
-        print(debug_out)
-    else:
-        print(info_out, end="\r")
 
-    req.add_header('Range', f"bytes={from_b}-{to_b}")
-    return urllib.request.urlopen(req).read()
+def err_exit(err_msg):
+    raise SystemExit(f"Error: {err_msg}")
 
 
-def get_segments(req, segments, chunk):
+def check_stop(what):
+    if stop_download.is_set():
+        raise RuntimeError(f"Download of {what} is stopped")
+
+
+def get_url(url, byte_range=None, size=None):
+    # download the URL, or only its byte range ('from-to' string) if it's given
+    # headers are built per call and nothing is shared but the session, so it's safe to call from several threads
+    # if 'size' of the range is known, the response is read right into a buffer of this size:
+    # it saves a copy of the whole response, made by requests when it joins the downloaded parts
+    headers = {'Range': f"bytes={byte_range}"} if byte_range else None
+    with session.get(url, headers=headers, stream=size is not None) as resp:
+        resp.raise_for_status()
+        # raw data can be read as is only if it's exactly the range we asked for
+        if size is None or resp.status_code != 206 or resp.headers.get('Content-Encoding'):
+            return resp.content
+
+        buf = bytearray(size)
+        with memoryview(buf) as view:
+            pos = 0
+            while pos < size:
+                check_stop(url)
+                # urllib3 reads into a temporary buffer of the asked size first, so keep it small
+                n = resp.raw.readinto(view[pos:pos + (1 << 20)])
+                if not n:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Connection closed after {pos} of {size} bytes: {url} ({byte_range})")
+                pos += n
+        return buf
+
+
+def get_media_byte_range(name, url, from_b, to_b, first_seg, last_seg, total_segs):
+    # print some progress info, then download the segment with actual 'Range' header
+    info_out = f"{name.capitalize()} segment: {last_seg + 1}/{total_segs} ({(last_seg + 1) / total_segs * 100:2.2f}%) "
+    debug_out = f"{name.capitalize()} segment: {first_seg + 1}-{last_seg + 1}/{total_segs}\t({last_seg - first_seg + 1})" \
+                f"\tbytes={from_b}-{to_b}\tsize={to_b - from_b + 1}"
+    global progress_time
+    with progress_lock:
+        if debug:
+            sys.stderr.write(debug_out + "\n")
+        else:
+            # always show the last segment, so the progress line ends with 100%
+            now = time.monotonic()
+            if now - progress_time >= PROGRESS_INTERVAL or last_seg + 1 == total_segs:
+                sys.stderr.write(info_out + "\r")
+                progress_time = now
+
+    return get_url(url, f"{from_b}-{to_b}", to_b - from_b + 1)
+
+
+def parse_segments(segments):
+    # parse all (URL, byte range) segment pairs just once, into parallel lists of URLs and start/end byte offsets
+    urls = []
+    starts = []
+    ends = []
+    for url, media_range in segments:
+        urls.append(url)
+        from_b, to_b = media_range.split('-', 1)
+        starts.append(int(from_b))
+        ends.append(int(to_b))
+    return urls, starts, ends
+
+
+def plan_run(seg_url, starts, ends, run_start, run_end, chunk):
+    # split run of segments with the same URL into chunks, returns list of chunk descriptors
+    chunks = []
+    seg_from = run_start
+    while seg_from < run_end:
+        # segments of one URL go one by one, so end byte offsets are sorted inside the run,
+        # and we can bisect for the first segment that makes the chunk exceed SAFE_CHUNK_LEN.
+        # chunk is limited by *_CHUNK_SEGMENTS too, and always has at least one segment
+        seg_to = bisect_right(
+            ends,
+            starts[seg_from] + safe_chunk_len - 1,
+            seg_from + 1,
+            min(seg_from + chunk, run_end)
+        ) - 1
+        chunks.append((seg_url, starts[seg_from], ends[seg_to], seg_from, seg_to))
+        seg_from = seg_to + 1
+    return chunks
+
+
+def plan_chunks(segments, chunk, first_seg=0):
     # will try to combine a few (*_CHUNK_SEGMENTS) segments to download together
     # it will significantly improve speed
-    media = b''
-    seg_pointer = 0
+    # returns list of (url, from_b, to_b, seg_from, seg_to) chunk descriptors, no actual download here
+    # segments before 'first_seg' (already downloaded ones) are skipped
+    urls, starts, ends = parse_segments(segments)
+    if first_seg >= len(urls):
+        return []
+
+    # usually all segments of a stream have the same URL, then it's just one run
+    if urls.count(urls[0]) == len(urls):
+        return plan_run(urls[0], starts, ends, first_seg, len(urls), chunk)
+
+    # otherwise a chunk can't cross the URL change, so split segments into runs with the same URL first
+    chunks = []
+    run_start = 0
+    for seg_url, run in groupby(urls):
+        run_end = run_start + len(list(run))
+        if run_end > first_seg:
+            chunks.extend(plan_run(seg_url, starts, ends, max(run_start, first_seg), run_end, chunk))
+        run_start = run_end
+
+    return chunks
+
+
+def get_segments(name, segments, chunk, out, first_seg=0, on_chunk=None):
+    # download all planned chunks, starting from 'first_seg' segment, up to PARALLEL_CHUNKS of them at once,
+    # and write every chunk into the 'out' file as soon as it's its turn
+    # on_chunk(next_seg) is called after every written chunk, if it's given
     total_segments = len(segments)
-
-    while seg_pointer < total_segments:
-        seg_url = segments[seg_pointer]["@media"]
-        # recreate request object if the URL of the next segment is different.
-        if seg_url != req.full_url:
-            req = urllib.request.Request(seg_url)
-
-        # start download chunk from this segment number
-        seg_from = seg_pointer
-        # start byte offset of this chunk
-        offs_a = int(segments[seg_from]["@mediaRange"].split('-')[0])
-
-        # check all segments in the chunk.
-        # if the next segment has another URL, or chunk size exceeds SAFE_CHUNK_LEN, we'll start a new chunk.
-        for seg_idx in range(seg_pointer, seg_pointer + chunk):
-            # finish this chunk if we reach the last segment or if next segment has another URL
-            if seg_pointer >= total_segments or seg_url != segments[seg_idx]["@media"]:
-                break
-
-            # end byte offset for current chunk
-            offs_b = int(segments[seg_idx]["@mediaRange"].split('-')[1])
-
-            # finish this chunk if chunk byte size exceeds SAFE_CHUNK_LEN
-            if offs_b - offs_a + 1 > safe_chunk_len:
+    chunks = iter(plan_chunks(segments, chunk, first_seg))
+
+    def fetch_range(chunk_info):
+        url, from_b, to_b, seg_from, seg_to = chunk_info
+        return seg_to, get_media_byte_range(name, url, from_b, to_b, seg_from, seg_to, total_segments)
+
+    # keep several requests in flight: while we're waiting for the oldest chunk,
+    # the next ones are already being downloaded, so the connections never stay idle.
+    # up to twice the number of workers is enough for that, but downloaded chunks wait in memory
+    # until it's their turn to be written, so the window is limited by bytes too:
+    # not more than 4 * SAFE_CHUNK_LEN (~96 MB by default) per stream, or one chunk if it's bigger
+    max_in_flight_len = 4 * safe_chunk_len
+    executor = ThreadPoolExecutor(max_workers=parallel_chunks)
+    try:
+        in_flight = deque()
+        in_flight_len = 0
+        chunk_info = next(chunks, None)
+        while True:
+            # schedule next chunks while there is room in the window
+            while chunk_info is not None and len(in_flight) < 2 * parallel_chunks:
+                chunk_len = chunk_info[2] - chunk_info[1] + 1
+                if in_flight and in_flight_len + chunk_len > max_in_flight_len:
+                    break
+                check_stop(f"{name} stream")
+                in_flight.append((executor.submit(fetch_range, chunk_info), chunk_len))
+                in_flight_len += chunk_len
+                chunk_info = next(chunks, None)
+            if not in_flight:
                 break
 
-            # if all checks pass, add this segment to the chunk and switch pointer to the next segment
-            seg_pointer += 1
-
-        # final end byte offset for this chunk
-        offs_b = int(segments[seg_pointer - 1]["@mediaRange"].split('-')[1])
-
-        # download the chunk
-        media += get_media_byte_range(req, offs_a, offs_b, seg_from, seg_pointer - 1, total_segments)
-
-    print("")
-    return media
+            job, chunk_len = in_flight.popleft()
+            seg_to, part = job.result()
+            check_stop(f"{name} stream")
+            out.write(part)
+            in_flight_len -= chunk_len
+            if on_chunk:
+                on_chunk(seg_to + 1)
+    except BaseException:
+        # don't wait for the chunks in flight, cancel all that haven't started yet
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+
+def is_better_stream(width, max_width, best):
+    # the first stream of max width is the best one, lower resolutions are skipped
+    return width >= max_width and (best is None or width > best["width"])
+
+
+def xml_unescape(value):
+    # decode XML entities, if any, in attribute value taken by regex
+    value = value.decode()
+    return html.unescape(value) if '&' in value else value
+
+
+def xml_attributes(raw):
+    # raises ValueError if attributes are written in some other way (single quotes, spaces around '='),
+    # so they aren't silently skipped
+    if ATTRIBUTE_RE.sub(b'', raw).strip() not in (b'', b'/'):
+        raise ValueError(f"Unexpected XML attributes: {raw.decode(errors='replace')}")
+    return {name.decode(): xml_unescape(value) for name, value in ATTRIBUTE_RE.findall(raw)}
+
+
+def find_elements(data, tag):
+    # yield (attributes, content) of every 'tag' element in raw XML, they must not be nested.
+    # plain bytes.find() is much faster here than a regex with lazy '.*?' over big element content
+    # raises ValueError if element isn't written as expected
+    start_tag = b'<' + tag
+    end_tag = b'</' + tag + b'>'
+    pos = data.find(start_tag)
+    while pos >= 0:
+        content_start = data.index(b'>', pos) + 1
+        attributes = data[pos + len(start_tag):content_start - 1]
+        # another tag with the same prefix, or element without content
+        if attributes[:1] not in (b'', b' ', b'\t', b'\r', b'\n') or attributes.endswith(b'/'):
+            raise ValueError(f"Unexpected {tag.decode()} element")
+        content_end = data.index(end_tag, content_start)
+        yield attributes, data[content_start:content_end]
+        pos = data.find(start_tag, content_end)
+
+
+def parse_mpd_fast(mpd_raw):
+    # fast path for parse_mpd(): find the elements we need right in raw XML, SegmentURL ones with a regex.
+    # it's much faster for manifests with thousands of segments, but relies on the usual MPD form,
+    # so it returns the same as parse_mpd(), or None if anything isn't as expected - then use parse_mpd()
+    streams = []
+    try:
+        for set_attributes, set_body in find_elements(mpd_raw, b'AdaptationSet'):
+            max_width = int(xml_attributes(set_attributes).get("maxWidth", 0))
+            best = None
+            best_body = b''
+            for representation_attributes, representation_body in find_elements(set_body, b'Representation'):
+                width = int(xml_attributes(representation_attributes).get("width", 0))
+                if is_better_stream(width, max_width, best):
+                    best = {"width": width}
+                    best_body = representation_body
+            init = INITIALIZATION_RE.search(best_body)
+            if init is None:
+                return None
+
+            init = xml_attributes(init.group(1))
+            if "sourceURL" not in init:
+                return None
+            best["init_url"] = init["sourceURL"]
+            best["init_range"] = init.get("range")
+            best["segments"] = [
+                (xml_unescape(url), media_range.decode()) for url, media_range in SEGMENT_URL_RE.findall(best_body)
+            ]
+            # every SegmentURL should be matched, otherwise it's written some other way
+            if len(best["segments"]) != best_body.count(b'<SegmentURL'):
+                return None
+            streams.append(best)
+    except ValueError:
+        return None
+
+    if len(streams) != mpd_raw.count(b'<AdaptationSet'):
+        return None
+    return streams
+
+
+def parse_mpd(mpd_raw):
+    # parse XML incrementally: take only attributes we need and clear every element as soon as it's parsed,
+    # so we never hold the whole element tree of a big manifest in memory
+    # returns list with the best (max width) representation of every adaptation set, as dicts:
+    # {"width", "init_url", "init_range", "segments"}, where the first media segment described
+    # in SegmentList/Initialization element, and all others - list of (URL, byte range) pairs
+    # from SegmentList/SegmentURL elements
+    streams = []
+    max_width = 0
+    # representation we are collecting now, None if it's skipped
+    representation = None
+    for event, elem in ET.iterparse(io.BytesIO(mpd_raw), events=('start', 'end')):
+        # MPD uses default XML namespace, strip it from the tag name
+        tag = elem.tag.rpartition('}')[2]
+
+        if event == 'start':
+            if tag == 'AdaptationSet':
+                streams.append(None)
+                max_width = int(elem.get("maxWidth", 0))
+            elif tag == 'Representation':
+                # skip low resolution streams right away, we need only one stream of every adaptation set
+                width = int(elem.get("width", 0))
+                if is_better_stream(width, max_width, streams[-1]):
+                    representation = {"width": width, "segments": []}
+                else:
+                    representation = None
+            continue
+
+        if representation is not None:
+            if tag == 'SegmentURL':
+                representation["segments"].append((elem.get("media"), elem.get("mediaRange")))
+            elif tag == 'Initialization':
+                representation["init_url"] = elem.get("sourceURL")
+                representation["init_range"] = elem.get("range")
+            elif tag == 'Representation':
+                streams[-1] = representation
+                representation = None
+        elem.clear()
+
+    return streams
+
+
+def open_fifo(path, proc):
+    # open named pipe for writing, when 'proc' opens it for reading.
+    # plain open() would block forever if the process exits before that, so wait for it in non-blocking mode
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            # ENXIO means nobody reads this pipe yet
+            if e.errno != errno.ENXIO:
+                raise
+            if proc.poll() is not None:
+                raise BrokenPipeError(errno.EPIPE, "Reader process has exited", path)
+            time.sleep(0.1)
+    os.set_blocking(fd, True)
+    return open(fd, "wb", buffering=1 << 20)
+
+
+class DirectIOFile:
+    # write-only file opened with O_DIRECT: multi-GB temporary files go to disk past the page cache,
+    # so they don't evict everything else from it.
+    # O_DIRECT requires aligned memory, sizes and offsets, so data is collected into page aligned mmap buffer
+    # and written by whole buffers; the unaligned tail is written with O_DIRECT switched off on flush,
+    # but it's kept in the buffer, and will be written again with the next data as a whole block.
+    BLOCK_SIZE = 4096
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path, size=0):
+        # first 'size' bytes of existing file are kept, writing continues after them
+        tail = size % self.BLOCK_SIZE
+        tail_data = b''
+        if tail:
+            with open(path, "rb") as f:
+                f.seek(size - tail)
+                tail_data = f.read(tail)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_DIRECT, 0o644)
+        os.ftruncate(self.fd, size)
+        os.lseek(self.fd, size - tail, os.SEEK_SET)
+        self.buf = mmap.mmap(-1, self.BUFFER_SIZE)
+        self.buf[:tail] = tail_data
+        self.used = tail
+
+    def _write_buf(self, size):
+        with memoryview(self.buf) as view:
+            written = 0
+            while written < size:
+                written += os.write(self.fd, view[written:size])
+
+    def write(self, data):
+        with memoryview(data) as data_view:
+            pos = 0
+            while pos < len(data_view):
+                n = min(len(data_view) - pos, self.BUFFER_SIZE - self.used)
+                self.buf[self.used:self.used + n] = data_view[pos:pos + n]
+                self.used += n
+                pos += n
+                if self.used == self.BUFFER_SIZE:
+                    self._write_buf(self.BUFFER_SIZE)
+                    self.used = 0
+        return len(data)
+
+    def flush(self):
+        aligned = self.used - self.used % self.BLOCK_SIZE
+        if aligned:
+            self._write_buf(aligned)
+            self.buf.move(0, aligned, self.used - aligned)
+            self.used -= aligned
+        if self.used:
+            # pwrite() doesn't move file offset, so the next aligned write starts from this tail again
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            with memoryview(self.buf) as view:
+                os.pwrite(self.fd, view[:self.used], os.lseek(self.fd, 0, os.SEEK_CUR))
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags)
+
+    def tell(self):
+        return os.lseek(self.fd, 0, os.SEEK_CUR) + self.used
+
+    def close(self):
+        if self.fd < 0:
+            return
+        self.flush()
+        os.close(self.fd)
+        self.fd = -1
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(path, size=0):
+    # open temporary file for writing, with O_DIRECT if it's asked and the filesystem supports it
+    # first 'size' bytes of existing file are kept, writing continues after them
+    if direct_io:
+        try:
+            return DirectIOFile(path, size)
+        except OSError as e:
+            # EINVAL: filesystem doesn't support O_DIRECT (tmpfs, for example)
+            if e.errno != errno.EINVAL:
+                raise
+    if not size:
+        return open(path, "wb", buffering=1 << 20)
+    out = open(path, "r+b", buffering=1 << 20)
+    out.truncate(size)
+    out.seek(size)
+    return out
+
+
+def load_progress(path, stream):
+    # state of partially downloaded stream, saved by save_progress(): number of the next segment to download,
+    # and how many bytes of the file are written before it. (0, 0) if there is nothing to continue
+    try:
+        with open(f"{path}.partial.json") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return 0, 0
+    # it should be the same stream, and the file shouldn't be shorter than it's written in the state
+    if state.get("init_url") != stream["init_url"] or state.get("total_segments") != len(stream["segments"]) \
+            or not os.path.exists(path) or os.path.getsize(path) < state.get("bytes_written", 0):
+        return 0, 0
+    return state["next_seg_index"], state["bytes_written"]
+
+
+def save_progress(path, stream, next_seg_index, bytes_written):
+    # write the state into another file first, then replace the old one, so it's never half-written
+    state_path = f"{path}.partial.json"
+    with open(f"{state_path}.tmp", "w") as f:
+        json.dump({
+            "init_url": stream["init_url"],
+            "total_segments": len(stream["segments"]),
+            "next_seg_index": next_seg_index,
+            "bytes_written": bytes_written,
+        }, f)
+    os.replace(f"{state_path}.tmp", state_path)
+
+
+def get_stream(name, stream, chunk, out_path, convert_proc=None):
+    # download the init segment of a stream, then all its media segments, into 'out_path'
+    # it's a temporary file, or a named pipe read by 'convert_proc', if it's given
+    if convert_proc is not None:
+        with open_fifo(out_path, convert_proc) as out:
+            out.write(get_url(stream["init_url"], stream["init_range"]))
+            get_segments(name, stream["segments"], chunk, out)
+        return
+
+    # continue download of the temporary file from where the previous run has stopped, if there is one
+    next_seg, bytes_written = load_progress(out_path, stream)
+    if next_seg >= len(stream["segments"]):
+        sys.stderr.write(f"{name.capitalize()} stream is already downloaded\n")
+    elif bytes_written:
+        sys.stderr.write(f"Continue {name} stream from segment {next_seg + 1}/{len(stream['segments'])}\n")
+
+    with open_output(out_path, bytes_written) as out:
+        def on_chunk(next_seg_index):
+            out.flush()
+            save_progress(out_path, stream, next_seg_index, out.tell())
+
+        if not bytes_written:
+            out.write(get_url(stream["init_url"], stream["init_range"]))
+            on_chunk(0)
+        get_segments(name, stream["segments"], chunk, out, next_seg, on_chunk)
 
 
 # ========== start here ===========
@@ -100,100 +517,139 @@ except IndexError:
     video_name = video_id
 
 baseurl = os.getenv("BASEURL", BASEURL)
-debug = os.getenv("DEBUG", DEBUG)
-audio_chunk_segments = os.getenv("AUDIO_CHUNK_SEGMENTS", AUDIO_CHUNK_SEGMENTS)
-video_chunk_segments = os.getenv("VIDEO_CHUNK_SEGMENTS", VIDEO_CHUNK_SEGMENTS)
-safe_chunk_len = os.getenv("SAFE_CHUNK_LEN", SAFE_CHUNK_LEN)
+debug = int(os.getenv("DEBUG", DEBUG))
+audio_chunk_segments = int(os.getenv("AUDIO_CHUNK_SEGMENTS", AUDIO_CHUNK_SEGMENTS))
+video_chunk_segments = int(os.getenv("VIDEO_CHUNK_SEGMENTS", VIDEO_CHUNK_SEGMENTS))
+safe_chunk_len = int(os.getenv("SAFE_CHUNK_LEN", SAFE_CHUNK_LEN))
+parallel_chunks = int(os.getenv("PARALLEL_CHUNKS", PARALLEL_CHUNKS))
+# named pipes are available on POSIX systems only
+use_fifo = int(os.getenv("USE_FIFO", USE_FIFO)) and hasattr(os, "mkfifo")
+# O_DIRECT is Linux-only
+direct_io = int(os.getenv("DIRECT_IO", DIRECT_IO)) and hasattr(os, "O_DIRECT")
 referer = os.getenv("REFERER", REFERER)
 
+# all requests go through one session: connections are kept alive and reused by all download threads,
+# so we don't pay TCP and TLS handshakes for every chunk
+session = requests.Session()
+session.headers['Referer'] = referer
+# audio and video streams are downloaded at the same time, each with up to PARALLEL_CHUNKS connections
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=2 * parallel_chunks))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=2 * parallel_chunks))
+
 
 
 # obtain XML with video segments description
 print("Get video description... ", end='')
-mpd_req = urllib.request.Request(f"{baseurl}/{video_id}/master.mpd")
-mpd_req.add_header('Referer', referer)
-mpd_raw = urllib.request.urlopen(mpd_req).read()
+mpd_raw = get_url(f"{baseurl}/{video_id}/master.mpd")
 
 # or can be read from file
-# with open("master.mpd", 'r') as f:
+# with open("master.mpd", 'rb') as f:
 #     mpd_raw = f.read()
 
-# parse XML into internal object
-mpd = xmltodict.parse(mpd_raw)
+# parse XML, take only what we need from it
+# AdaptationSet[0] - video streams with different resolutions, we get the best available one
+# AdaptationSet[1] - the only audio stream
+video_stream, audio_stream = (parse_mpd_fast(mpd_raw) or parse_mpd(mpd_raw))[:2]
 print("Done.\n")
 
 # To get any media segment, we need provide its URL and 'Range' header
 # this info present in XML description
 
-# mpd['MPD']['Period']['AdaptationSet'][0]["Representation"] - array of video streams with different resolutions
-# mpd['MPD']['Period']['AdaptationSet'][1]["Representation"] - the only audio stream
-
-# the first media segment described in ["SegmentList"]["Initialization"] field
-# all others - array of URL/range pairs at ["SegmentList"]["SegmentURL"]
-
-# Download audio stream
-print("Get audio stream...")
-# First, we are prepare to download init segment for this stream
-audio_url = mpd['MPD']['Period']['AdaptationSet'][1]["Representation"]["SegmentList"]["Initialization"]["@sourceURL"]
-bytes_range = mpd['MPD']['Period']['AdaptationSet'][1]["Representation"]["SegmentList"]["Initialization"]["@range"]
-# create request object
-audio_req = urllib.request.Request(audio_url)
-# add actual Range header
-audio_req.add_header('Range', f"bytes={bytes_range}")
-# download init segment
-audio = urllib.request.urlopen(audio_req).read()
-# Download all other segments for this stream
-audio += get_segments(
-    audio_req,
-    mpd['MPD']['Period']['AdaptationSet'][1]["Representation"]["SegmentList"]["SegmentURL"],
-    audio_chunk_segments
-)
-
-# Save audio stream in temporary file
-with open(f"{video_id}.audio", "wb") as f:
-    f.write(audio)
-print("Audio stream done.\n")
-
-
-# Download video stream
-print("Get video stream...")
-# get the best available resolution
-max_width = int(mpd['MPD']['Period']['AdaptationSet'][0]["@maxWidth"])
-
-video = b''
-for video_stream in mpd['MPD']['Period']['AdaptationSet'][0]["Representation"]:
-    # skip low resolution video streams
-    if int(video_stream["@width"]) < max_width:
-        continue
-
-    video_url = video_stream["SegmentList"]["Initialization"]["@sourceURL"]
-    bytes_range = video_stream["SegmentList"]["Initialization"]["@range"]
-    video_req = urllib.request.Request(video_url)
-    video_req.add_header('Range', f"bytes={bytes_range}")
-    video = urllib.request.urlopen(video_req).read()
-    video += get_segments(
-        video_req,
-        video_stream["SegmentList"]["SegmentURL"],
-        video_chunk_segments
-    )
-    # we need only one video stream
-    break
-
-# save video stream in temporary file
-with open(f"{video_id}.video", "wb") as f:
-    f.write(video)
-print("Video stream done.\n")
+# Audio and video streams are independent, so download them at the same time:
+# network latency of one stream overlaps with the other one.
+print("Get audio and video streams...")
 
-# Combine audio and video streams in one ready-to-play MP4 container
-convert_cmd = f"ffmpeg -y -i {video_id}.video -i {video_id}.audio -c copy -bsf:a aac_adtstoasc {video_name}.mp4"
-print("Converting video file... ", end='')
-sys.stdout.flush()
-run_res = subprocess.run(convert_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-if run_res.returncode:
-    err_exit(f"Error video convert invocation: {run_res.stderr.decode()}")
+if use_fifo:
+    # ffmpeg reads streams from named pipes while we download them, without any temporary files on disk
+    fifo_dir = tempfile.mkdtemp(prefix="kinescope-")
+    audio_path = os.path.join(fifo_dir, f"{video_id}.audio")
+    video_path = os.path.join(fifo_dir, f"{video_id}.video")
 else:
-    os.unlink(f"{video_id}.audio")
-    os.unlink(f"{video_id}.video")
-    print(f"Done: {video_name}.mp4")
+    audio_path = f"{video_id}.audio"
+    video_path = f"{video_id}.video"
 
-pass
+# Combine audio and video streams in one ready-to-play MP4 container
+# command is passed as arguments list, without shell, so any video name is safe here
+# -nostdin: ffmpeg may run for the whole download, don't let it take keypresses and terminal from us
+convert_cmd = [
+    "ffmpeg", "-nostdin", "-y",
+    "-i", video_path,
+    "-i", audio_path,
+    "-c", "copy", "-bsf:a", "aac_adtstoasc",
+    f"{video_name}.mp4"
+]
+# check it before the download, not after it
+if shutil.which(convert_cmd[0]) is None:
+    err_exit(f"'{convert_cmd[0]}' utility is not found, please install it")
+
+convert_proc = None
+downloaded = False
+converted = False
+try:
+    if use_fifo:
+        os.mkfifo(audio_path)
+        os.mkfifo(video_path)
+        # ffmpeg works together with download, so don't let its output fill the pipe, keep it in a file
+        convert_err = tempfile.TemporaryFile()
+        convert_proc = subprocess.Popen(convert_cmd, stdout=subprocess.DEVNULL, stderr=convert_err)
+
+    # Audio and video streams are written chunk by chunk, so we never hold a whole stream in memory
+    try:
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            jobs = [
+                executor.submit(get_stream, "audio", audio_stream, audio_chunk_segments, audio_path, convert_proc),
+                executor.submit(get_stream, "video", video_stream, video_chunk_segments, video_path, convert_proc),
+            ]
+            # re-raise the first download error as soon as it happens, don't wait for the other stream
+            done, _ = wait(jobs, return_when=FIRST_EXCEPTION)
+            for job in done:
+                job.result()
+        except BaseException:
+            # stop the other stream too, on download error or Ctrl-C
+            stop_download.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+    except BrokenPipeError:
+        # ffmpeg has exited before reading the whole stream, its error is reported below
+        if convert_proc is None:
+            raise
+    downloaded = True
+    sys.stderr.write("\n")
+    print("Audio and video streams done.\n")
+
+    print("Converting video file... ", end='')
+    sys.stdout.flush()
+    if convert_proc is None:
+        run_res = subprocess.run(convert_cmd, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        returncode, convert_errors = run_res.returncode, run_res.stderr
+    else:
+        returncode = convert_proc.wait()
+        convert_err.seek(0)
+        convert_errors = convert_err.read()
+    if returncode:
+        err_exit(f"Error video convert invocation: {convert_errors.decode()}")
+    print(f"Done: {video_name}.mp4")
+    converted = True
+finally:
+    if convert_proc is not None and convert_proc.poll() is None:
+        convert_proc.kill()
+        convert_proc.wait()
+    if use_fifo:
+        for fifo in (audio_path, video_path):
+            if os.path.exists(fifo):
+                os.unlink(fifo)
+        os.rmdir(fifo_dir)
+    elif converted:
+        for temp_file in (audio_path, video_path, f"{audio_path}.partial.json", f"{video_path}.partial.json"):
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+    elif downloaded:
+        # both streams are complete, another run would just repeat the same conversion error
+        sys.stderr.write(f"\nDownloaded streams are kept in {audio_path} and {video_path}, "
+                         f"but video conversion hasn't finished\n")
+    else:
+        # keep partially downloaded streams, the next run will continue from where this one has stopped
+        sys.stderr.write(f"\nDownloaded data is kept in {audio_path} and {video_path}, "
+                         f"run the script again to continue\n")